@@ -61,17 +61,24 @@ __status__ = "Production"
 __version__ = "0.1.2"
 
 import cgi
+import collections
 import copy
 import datetime
+import multiprocessing
+import random
 import StringIO
+from xml.sax.saxutils import unescape
 
 import xlwt
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_RIGHT
+from reportlab.lib.fonts import ps2tt, tt2ps
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.units import inch
-from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
+from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.platypus.tables import TableStyle, Table
+from reportlab.rl_config import defaultPageSize
 
 
 class StyleAttributes(object):
@@ -101,6 +108,10 @@ class StyleAttributes(object):
     def __getattr__(self, key):
         """Return the requested property after applying appropriate
         processing to it"""
+        # Leave special attributes alone so that copy and pickle (and
+        # therefore multiprocessing) can handle these objects
+        if key.startswith('__'):
+            raise AttributeError(key)
         value = self.properties.get(key, None)
         if key == 'width' and value is not None:
             return value * inch
@@ -129,7 +140,11 @@ class Cell(object):
 
 
 class TableRow(object):
-    """A TableRow is a list of cells"""
+    """A TableRow is a list of cells. Rows made by a RowSpec remember
+    it as 'rowspec' so that table generators can reuse work across
+    all of its rows."""
+
+    rowspec = None
 
     def __init__(self, *cells):
         """Store the given list of cells"""
@@ -214,7 +229,9 @@ class RowSpec(object):
                 except (KeyError, TypeError):
                     value = getattr(value, attribute)
             output.append(Cell(value, column.style))
-        return TableRow(*output)
+        row = TableRow(*output)
+        row.rowspec = self
+        return row
 
     def __iter__(self):
         """Return each of the row's ColumnSpecs in turn"""
@@ -264,6 +281,13 @@ class TableBase(object):
         else:
             self.headers = headers
 
+    @staticmethod
+    def _listrowsets(rowsets):
+        """Return the rowsets as a list of lists of TableRows, so that
+        they can be traversed more than once or pickled"""
+        return [[rowset] if isinstance(rowset, TableRow) else list(rowset)
+                for rowset in rowsets]
+
     def _cast(self, cell):
         """This doesn't do a lot right now, but this is where we'd
         implement code to convert various datatypes to their desired
@@ -278,7 +302,24 @@ class TableBase(object):
 
 
 class PDFTable(TableBase):
-    """Table generator that yields a PDF representation of the data"""
+    """Table generator that yields a PDF representation of the data.
+
+    Columns whose ColumnSpecs don't give a width are normally sized by
+    ReportLab, which measures every cell in them. In autowidth mode,
+    their widths are instead estimated from the font metrics of a
+    bounded sample of the cells in each row layout: the first and last
+    'autowidthsample' rows plus that many chosen at random from the
+    whole table. A layout is the number of columns and each column's
+    width and span settings, so a header and the rows under it line up
+    whether they were built by the same RowSpec, by different ones, or
+    by hand, and whether or not they're bold. The resulting fixed
+    widths fill the page."""
+
+    autowidth = False
+    autowidthsample = 50
+    minautowidth = .5 * inch
+    pagemargin = .5 * inch
+    cellpadding = 3
 
     rowoddcolor = colors.Color(.92, .92, .92)
     gridcolor = colors.Color(.8, .8, .8)
@@ -303,12 +344,6 @@ class PDFTable(TableBase):
             ('BOX', (0, 0), (-1, -1), 1, colors.black),
             ])
 
-    # Give content rows a little bit of side padding
-    tablerowstyle = TableStyle([
-            ('LEFTPADDING', (0, 0), (-1, -1), 3),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 3),
-            ])
-
     tableheaderstyle = TableStyle([
             ('BACKGROUND', (0, 0), (-1, -1), headerbackgroundcolor),
             ])
@@ -319,6 +354,123 @@ class PDFTable(TableBase):
     contentcellstyle = ParagraphStyle(name='Table Cell Style', fontName='Helvetica', fontSize=8)
     contentmoneycellstyle = ParagraphStyle(name='Table Cell Style', fontName='Helvetica', fontSize=8, alignment=TA_RIGHT)
 
+    @property
+    def tablerowstyle(self):
+        """Give content rows a little bit of side padding. This is
+        built from cellpadding on demand so that subclasses can
+        change it and still have autowidth estimates match."""
+        return TableStyle([
+                ('LEFTPADDING', (0, 0), (-1, -1), self.cellpadding),
+                ('RIGHTPADDING', (0, 0), (-1, -1), self.cellpadding),
+                ])
+
+    def __init__(self, title=None, explanation=None, headers=None, autowidth=None):
+        """'autowidth', if given, overrides the class's autowidth
+        setting. See TableBase for the other arguments."""
+        super(PDFTable, self).__init__(title, explanation, headers)
+        if autowidth is not None:
+            self.autowidth = autowidth
+
+    @staticmethod
+    def _layout(columns):
+        """Return the key identifying the layout of a row of cells or
+        ColumnSpecs: each column's width and span settings"""
+        return tuple((column.style.width, column.style.span) for column in columns)
+
+    def _textwidth(self, text, style, bold=False):
+        """Return the width of the text as a Paragraph in the given
+        style would draw it on a single line, including padding"""
+        fontname = style.fontName
+        if bold:
+            fontname = tt2ps(ps2tt(fontname)[0], 1, 0)
+        text = ' '.join(unescape(text).split())
+        return stringWidth(text, fontname, style.fontSize) + 2 * self.cellpadding
+
+    def _fitwidths(self, layout, desired):
+        """Return the column widths for a layout. Columns with an
+        explicit width keep it. The others get their desired widths
+        when they fit on the page, with any leftover space going to
+        the last of them. Otherwise the narrowest keep their desired
+        widths and the rest split the remaining space evenly."""
+        widths = [width for width, span in layout]
+        autocolumns = [index for index, width in enumerate(widths) if width is None]
+        if not autocolumns:
+            return widths
+        available = (defaultPageSize[0] - 2 * self.pagemargin
+                     - sum(width for width in widths if width is not None))
+        if sum(desired[index] for index in autocolumns) <= available:
+            for index in autocolumns:
+                widths[index] = desired[index]
+                available -= desired[index]
+            widths[autocolumns[-1]] += available
+            return widths
+        pending = sorted(autocolumns, key=lambda index: desired[index])
+        while pending:
+            share = available / len(pending)
+            if desired[pending[0]] > share:
+                break
+            index = pending.pop(0)
+            widths[index] = desired[index]
+            available -= desired[index]
+        for index in pending:
+            widths[index] = max(share, self.minautowidth)
+        return widths
+
+    def _autowidths(self, rowsets):
+        """Return a dict mapping each layout in the headers and rowsets
+        to its estimated column widths"""
+        samplesize = self.autowidthsample
+        randomizer = random.Random(0)
+        samplers = {}
+
+        # Collect the head, tail, and a random reservoir of each
+        # layout's rows in a single pass
+        for rowset in rowsets:
+            for subrow in rowset:
+                cells = tuple(subrow)
+                layout = self._layout(cells)
+                try:
+                    head, tail, reservoir, seen = samplers[layout]
+                except KeyError:
+                    head, tail, reservoir, seen = samplers[layout] = \
+                        [], collections.deque(maxlen=samplesize), [], [0]
+                seen[0] += 1
+                if len(head) < samplesize:
+                    head.append(cells)
+                    continue
+                tail.append(cells)
+                if len(reservoir) < samplesize:
+                    reservoir.append(cells)
+                else:
+                    slot = randomizer.randrange(seen[0] - samplesize)
+                    if slot < samplesize:
+                        reservoir[slot] = cells
+
+        # Start each layout's desired widths with its header titles
+        desiredwidths = {}
+        for headerrow in self.headers or []:
+            layout = self._layout(headerrow)
+            desired = desiredwidths.setdefault(layout, [0] * len(layout))
+            for index, headercolumn in enumerate(headerrow):
+                desired[index] = max(desired[index],
+                                     self._textwidth(unicode(headercolumn.title),
+                                                     self.headercellstyle))
+
+        # Widen them to fit the sampled cells
+        for layout, (head, tail, reservoir, seen) in samplers.items():
+            desired = desiredwidths.setdefault(layout, [0] * len(layout))
+            for cells in head + list(tail) + reservoir:
+                for index, cell in enumerate(cells):
+                    if cell.style.money:
+                        style = self.contentmoneycellstyle
+                    else:
+                        style = self.contentcellstyle
+                    desired[index] = max(desired[index],
+                                         self._textwidth(self._cast(cell), style, cell.style.bold))
+
+        return dict((layout, self._fitwidths(layout, desired))
+                    for layout, desired in desiredwidths.items())
+
     def _rendercell(self, cell):
         """Render data as a Paragraph"""
 
@@ -334,22 +486,35 @@ class PDFTable(TableBase):
             style = self.contentcellstyle
         return Paragraph(value, style)
 
-    def render(self, rowsets):
-        """Return the data as a binary string holding a PDF"""
+    def _components(self, rowsets):
+        """Return the list of flowables that make up the table"""
+
+        # Estimating widths takes a pass over the rows before we lay
+        # them out, so they can't be consumed as we go
+        autowidths = None
+        if self.autowidth:
+            rowsets = self._listrowsets(rowsets)
+            autowidths = self._autowidths(rowsets)
+
+        tablerowstyle = self.tablerowstyle
 
         # Start by creating the table headers
         rowtables = []
         if self.headers:
             for headerrow in self.headers:
-                widths = [headercolumn.style.width for headercolumn in headerrow]
-                # Let ReportLab calculate the width of the last column
-                # so that it occupies the total remaining open space
-                widths[-1] = None
+                if autowidths is not None:
+                    widths = list(autowidths[self._layout(headerrow)])
+                else:
+                    widths = [headercolumn.style.width for headercolumn in headerrow]
+                    # Let ReportLab calculate the width of the last
+                    # column so that it occupies the total remaining
+                    # open space
+                    widths[-1] = None
                 headertable = Table([[Paragraph(headercolumn.title, self.headercellstyle)
                                       for headercolumn in headerrow]],
                                     style=self.tablebasestyle,
                                     colWidths=widths)
-                headertable.setStyle(self.tablerowstyle)
+                headertable.setStyle(tablerowstyle)
                 headertable.setStyle(self.tableheaderstyle)
                 rowtables.append([headertable])
 
@@ -359,10 +524,14 @@ class PDFTable(TableBase):
             if isinstance(rowset, TableRow):
                 rowset = [rowset]
             for subrow in rowset:
+                if autowidths is not None:
+                    widths = list(autowidths[self._layout(subrow)])
+                else:
+                    widths = [cell.style.width for cell in subrow]
                 subrowtable = Table([[self._rendercell(cell) for cell in subrow]],
                                     style=self.tablebasestyle,
-                                    colWidths=[cell.style.width for cell in subrow])
-                subrowtable.setStyle(self.tablerowstyle)
+                                    colWidths=widths)
+                subrowtable.setStyle(tablerowstyle)
                 subrowtables.append([subrowtable])
 
             rowtable = Table(subrowtables, style=self.tablebasestyle)
@@ -381,15 +550,37 @@ class PDFTable(TableBase):
             components.extend([Spacer(1, .2 * inch),
                                Paragraph(self.explanation, self.explanationstyle)])
         components.extend([Spacer(1, .3 * inch), parenttable])
+        return components
 
-        # Compile the whole thing and return the results
+    @classmethod
+    def _build(cls, components):
+        """Compile a list of flowables into a binary string holding a
+        PDF"""
         stringbuf = StringIO.StringIO()
-        doc = SimpleDocTemplate(stringbuf,
-                                bottomMargin=.5 * inch, topMargin=.5 * inch,
-                                rightMargin=.5 * inch, leftMargin=.5 * inch)
+        doc = SimpleDocTemplate(stringbuf, pagesize=defaultPageSize,
+                                bottomMargin=cls.pagemargin, topMargin=cls.pagemargin,
+                                rightMargin=cls.pagemargin, leftMargin=cls.pagemargin)
         doc.build(components)
         return stringbuf.getvalue()
 
+    def render(self, rowsets):
+        """Return the data as a binary string holding a PDF"""
+        return self._build(self._components(rowsets))
+
+    @classmethod
+    def rendercombined(cls, tablerowsets):
+        """Return a binary string holding a single PDF with each table
+        starting on a new page. 'tablerowsets' is a collection of
+        (table, rowsets) pairs, where each table is a PDFTable and its
+        rowsets are what would otherwise be passed to its render
+        method."""
+        components = []
+        for table, rowsets in tablerowsets:
+            if components:
+                components.append(PageBreak())
+            components.extend(table._components(rowsets))
+        return cls._build(components)
+
 
 class SpreadsheetTable(TableBase):
     """Table generator that yields an Excel spreadsheet representation
@@ -400,6 +591,9 @@ class SpreadsheetTable(TableBase):
                               'font: colour white, bold True;')
     explanationstyle = xlwt.easyxf('font: bold True;')
 
+    # Excel won't accept longer worksheet names than this
+    maxsheetname = 31
+
     # Styles to apply to given data types. The style for None is the
     # default when no other type is applicable.
     styletypemap = {
@@ -441,10 +635,9 @@ class SpreadsheetTable(TableBase):
         cellstyles[tuple(sorted(attrs))] = cellstyle
         return cellstyle
 
-    def render(self, rowsets):
-        """Return the data as a binary string holding an Excel spreadsheet"""
-        book = xlwt.Workbook()
-        mainsheet = book.add_sheet(self.title or 'Sheet 1')
+    def _writesheet(self, book, rowsets, sheetname):
+        """Add a worksheet holding the data to the workbook"""
+        mainsheet = book.add_sheet(sheetname)
         rownum = 0
 
         if self.explanation:
@@ -476,6 +669,32 @@ class SpreadsheetTable(TableBase):
                     colnum += cell.style.span
                 rownum += 1
 
+    def render(self, rowsets):
+        """Return the data as a binary string holding an Excel spreadsheet"""
+        book = xlwt.Workbook()
+        self._writesheet(book, rowsets, self.title or 'Sheet 1')
+        stringbuf = StringIO.StringIO()
+        book.save(stringbuf)
+        return stringbuf.getvalue()
+
+    @classmethod
+    def rendercombined(cls, tablerowsets):
+        """Return a binary string holding a single Excel spreadsheet
+        with one worksheet per table. Worksheet names must be unique,
+        so repeated titles are numbered, and short enough for Excel,
+        so long titles are truncated."""
+        book = xlwt.Workbook()
+        sheetnames = set()
+        for tablenum, (table, rowsets) in enumerate(tablerowsets):
+            basename = table.title or 'Sheet %d' % (tablenum + 1)
+            sheetname = basename[:cls.maxsheetname]
+            copynum = 1
+            while sheetname.lower() in sheetnames:
+                copynum += 1
+                suffix = ' (%d)' % copynum
+                sheetname = basename[:cls.maxsheetname - len(suffix)] + suffix
+            sheetnames.add(sheetname.lower())
+            table._writesheet(book, rowsets, sheetname)
         stringbuf = StringIO.StringIO()
         book.save(stringbuf)
         return stringbuf.getvalue()
@@ -520,24 +739,45 @@ class HTMLTable(TableBase):
         'zebra': ('odd', 'even'),
         }
 
-    def _rendercell(self, cell):
-        """Render data as a td"""
+    @staticmethod
+    def _celllayout(style):
+        """Return the style values that affect a cell's td tag"""
+        return style.bold, style.money, style.span
+
+    def _cellprefix(self, celllayout):
+        """Return the opening td tag for cells with the given layout"""
 
+        bold, money, colspan = celllayout
         cssclasses = []
-        if cell.style.bold:
+        if bold:
             cssclasses.append(self.cssdefs['bold'])
-        if cell.style.money:
+        if money:
             cssclasses.append(self.cssdefs['money'])
         if cssclasses:
             cssstring = ' class="%s"' % ' '.join(cssclasses)
         else:
             cssstring = ''
-        colspan = cell.style.span
         if colspan > 1:
             colspanstring = ' colspan="%d"' % colspan
         else:
             colspanstring = ''
-        return '<td%s%s>%s</td>' % (cssstring, colspanstring, self._cast(cell).replace('\r', '<br />'))
+        return '<td%s%s>' % (cssstring, colspanstring)
+
+    def _cellvalue(self, cell):
+        """Return a cell's contents as they'll appear inside its td"""
+        return self._cast(cell).replace('\r', '<br />')
+
+    def _rendercell(self, cell):
+        """Render data as a td"""
+        return '%s%s</td>' % (self._cellprefix(self._celllayout(cell.style)),
+                              self._cellvalue(cell))
+
+    def _compilerow(self, rowlayout):
+        """Return a format string that renders all of the td lines of
+        a row whose cells have the given layouts. It takes one
+        argument per cell: that cell's rendered value."""
+        return '\n'.join('      %s%%s</td>' % self._cellprefix(celllayout).replace('%', '%%')
+                         for celllayout in rowlayout)
 
     def render(self, rowsets):
         """Return the data as a string of HTML"""
@@ -573,17 +813,49 @@ class HTMLTable(TableBase):
             lines.append('  </thead>')
         lines.append('  <tbody>')
 
+        # Every tr tag is one of these, indexed by its rowset's zebra
+        # stripe and then by whether it's a child row
+        trtags = [['    <tr class="%s">' % zebra,
+                   '    <tr class="%s %s">' % (zebra, self.cssdefs['childrow'])]
+                  for zebra in self.cssdefs['zebra']]
+
+        # A cell's td tag depends only on its bold, money, and span
+        # settings. Every row made by a RowSpec has the same ones, so
+        # compile its td tags the first time we see it and reuse them
+        # for the rest of the table. Rows built by hand may differ
+        # from one to the next, so reuse each cell's opening tag
+        # instead.
+        rowtemplates = {}
+        cellprefixes = {}
+        celllayout = self._celllayout
+        cast = self._cast
+
         # Write every line
         for rowsetindex, rowset in enumerate(rowsets):
             if isinstance(rowset, TableRow):
                 rowset = [rowset]
+            zebratags = trtags[rowsetindex % 2]
             for subrowindex, subrow in enumerate(rowset):
-                trclasses = [self.cssdefs['zebra'][rowsetindex % 2]]
-                if subrowindex:
-                    trclasses.append(self.cssdefs['childrow'])
-                lines.append('    <tr class="%s">' % ' '.join(trclasses))
-                for cell in subrow:
-                    lines.append('      %s' % self._rendercell(cell))
+                lines.append(zebratags[bool(subrowindex)])
+                rowspec = getattr(subrow, 'rowspec', None)
+                if rowspec is not None:
+                    cells = subrow.cells
+                    try:
+                        rowtemplate = rowtemplates[rowspec]
+                    except KeyError:
+                        rowtemplate = rowtemplates[rowspec] = self._compilerow(
+                            [celllayout(cell.style) for cell in cells])
+                    if cells:
+                        lines.append(rowtemplate % tuple([cast(cell).replace('\r', '<br />')
+                                                          for cell in cells]))
+                else:
+                    for cell in subrow:
+                        layout = celllayout(cell.style)
+                        try:
+                            prefix = cellprefixes[layout]
+                        except KeyError:
+                            prefix = cellprefixes[layout] = '      ' + self._cellprefix(layout)
+                        lines.append('%s%s</td>' % (prefix, cast(cell).replace('\r', '<br />')))
                 lines.append('    </tr>')
 
         # Finish up
@@ -591,6 +863,93 @@ class HTMLTable(TableBase):
         lines.append('</table>')
         return '\n'.join(lines)
 
+    @classmethod
+    def rendercombined(cls, tablerowsets):
+        """Return a string of HTML holding each of the tables in turn"""
+        return '\n'.join(table.render(rowsets) for table, rowsets in tablerowsets)
+
+
+def _maketable(tableclass, job):
+    """Return the (table, rowsets) pair described by a TableBatch job"""
+    title, headers, rowsets = job[:3]
+    if len(job) > 3:
+        options = job[3]
+    else:
+        options = {}
+    return tableclass(title, headers=headers, **options), rowsets
+
+
+def _renderjob(args):
+    """Render one TableBatch job. This lives at the module level so
+    that multiprocessing can send it to worker processes."""
+    table, rowsets = _maketable(*args)
+    return table.render(rowsets)
+
+
+class TableBatch(object):
+    """A TableBatch renders many tables of the same class, such as a
+    night's worth of one-page customer statements. It can render them
+    in parallel as separate documents, or together as one document.
+
+    Each job is a (title, headers, rowsets) tuple holding the
+    arguments that would otherwise be passed to the table class and
+    its render method. It may have a fourth element: a dict of any
+    other keyword arguments for the table class, such as
+    {'explanation': 'Invoices for March'} or, for PDFTable,
+    {'autowidth': True}."""
+
+    def __init__(self, tableclass, processes=None, chunksize=None):
+        """'tableclass' is the table generator used for every job,
+        such as PDFTable. 'processes' is the most worker processes
+        that render() spreads the jobs across, defaulting to the
+        number of CPUs. No more are started than there are jobs, and
+        if that leaves only one, everything is rendered in the
+        current process. 'chunksize' is the number of jobs sent
+        to a worker at a time, defaulting to enough to give each
+        worker about four chunks."""
+        self.tableclass = tableclass
+        self.processes = processes
+        self.chunksize = chunksize
+
+    def render(self, jobs):
+        """Return a list holding the rendered output of each job, in
+        the same order as the jobs. This is a parallel wrapper around
+        the table class's render method: every job gets its own
+        document, built exactly as a single render would build it.
+        Use rendercombined to share one document across the tables.
+
+        Rowsets are copied into lists before they're sent to the
+        workers, so they may be generators."""
+        args = []
+        for job in jobs:
+            job = tuple(job)
+            rowsets = self.tableclass._listrowsets(job[2])
+            args.append((self.tableclass, job[:2] + (rowsets,) + job[3:]))
+        processes = min(self.processes or multiprocessing.cpu_count(), len(args))
+        if processes <= 1:
+            return [_renderjob(arg) for arg in args]
+        chunksize = self.chunksize
+        if chunksize is None:
+            chunksize, extra = divmod(len(args), processes * 4)
+            if extra or not chunksize:
+                chunksize += 1
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(_renderjob, args, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    def rendercombined(self, jobs):
+        """Return a single document holding every job's table: one
+        worksheet per table for spreadsheets, or a page break between
+        tables for PDFs. Styles, the workbook, and the document
+        template are shared across all of the tables. This runs in
+        the current process because the backends can only assemble a
+        document in one place."""
+        return self.tableclass.rendercombined(
+            _maketable(self.tableclass, job) for job in jobs)
+
 
 def example():
     """Create a set of sample tables"""
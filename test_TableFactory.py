@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+"""Tests for TableFactory"""
+
+import unittest
+
+from reportlab.lib.units import inch
+from reportlab.platypus import PageBreak
+from reportlab.rl_config import defaultPageSize
+
+from TableFactory import (Cell, ColumnSpec, HTMLTable, PDFTable, RowSpec, SpreadsheetTable,
+                          StyleAttributes, TableBatch, TableRow)
+
+
+class PDFAutoWidthTests(unittest.TestCase):
+    """Tests for PDFTable's autowidth mode"""
+
+    def setUp(self):
+        self.rowspec = RowSpec(ColumnSpec('id', 'ID'),
+                               ColumnSpec('name', 'Customer Name'))
+        self.rows = [self.rowspec({'id': index, 'name': 'Customer %d' % index})
+                     for index in range(20)]
+
+    def assertAligned(self, table, rowsets):
+        """Assert that the header and every row get the same widths"""
+        autowidths = table._autowidths(rowsets)
+        headerwidths = autowidths[table._layout(table.headers[0])]
+        for rowset in rowsets:
+            for subrow in rowset:
+                self.assertEqual(autowidths[table._layout(subrow)], headerwidths)
+        self.assertEqual(len(autowidths), 1)
+
+    def test_rowspec_rows_match_header(self):
+        """Rows built by the header's RowSpec line up with it"""
+        table = PDFTable('Test', headers=self.rowspec, autowidth=True)
+        self.assertAligned(table, [[row] for row in self.rows])
+
+    def test_handbuilt_rows_match_header(self):
+        """Rows built by hand line up with the header and each other"""
+        rows = [TableRow(Cell(index), Cell('x' * index)) for index in range(20)]
+        table = PDFTable('Test', headers=self.rowspec, autowidth=True)
+        self.assertAligned(table, [[row] for row in rows])
+
+    def test_other_rowspec_rows_match_header(self):
+        """Rows built by an equivalent RowSpec line up with the header"""
+        otherspec = RowSpec(ColumnSpec('id'), ColumnSpec('name'))
+        rows = [otherspec({'id': index, 'name': 'Customer'}) for index in range(20)]
+        table = PDFTable('Test', headers=self.rowspec, autowidth=True)
+        self.assertAligned(table, [[row] for row in rows])
+
+    def test_bold_total_row_matches_header(self):
+        """A bold total row from another RowSpec lines up with the
+        header and the rows above it"""
+        totalspec = RowSpec(ColumnSpec('id', bold=True), ColumnSpec('name', bold=True))
+        total = totalspec({'id': 'Total', 'name': '1,234.56'})
+        table = PDFTable('Test', headers=self.rowspec, autowidth=True)
+        self.assertAligned(table, [[row] for row in self.rows] + [[total]])
+
+    def test_money_handbuilt_row_matches_header(self):
+        """A hand-built row with different money settings lines up
+        with the header"""
+        row = TableRow(Cell(1), Cell('12.50', StyleAttributes(money=True)))
+        table = PDFTable('Test', headers=self.rowspec, autowidth=True)
+        self.assertAligned(table, [[row] for row in self.rows] + [[row]])
+
+    def test_repeated_header_layouts_merge(self):
+        """Header rows with the same layout all widen their columns"""
+        longspec = RowSpec(ColumnSpec('id', 'A very very very long header title'),
+                           ColumnSpec('name', 'Name'))
+        shortspec = RowSpec(ColumnSpec('id', 'x'), ColumnSpec('name', 'Name'))
+        table = PDFTable('Test', headers=[longspec, shortspec], autowidth=True)
+        widths = table._autowidths([])[table._layout(longspec)]
+        self.assertTrue(widths[0] >= table._textwidth('A very very very long header title',
+                                                      table.headercellstyle))
+
+    def test_cellpadding_matches_estimate(self):
+        """Overriding cellpadding changes both the estimate and the
+        padding the rows are drawn with"""
+
+        class PaddedTable(PDFTable):
+            cellpadding = 10
+
+        table = PaddedTable('Test', autowidth=True)
+        self.assertEqual(table._textwidth('', table.contentcellstyle), 20)
+        paddings = [command[-1] for command in table.tablerowstyle.getCommands()
+                    if command[0] in ('LEFTPADDING', 'RIGHTPADDING')]
+        self.assertEqual(paddings, [10, 10])
+
+
+class PDFFitWidthsTests(unittest.TestCase):
+    """Tests for fitting estimated widths onto the page"""
+
+    def setUp(self):
+        self.table = PDFTable('Test', autowidth=True)
+        self.available = defaultPageSize[0] - 2 * self.table.pagemargin
+
+    @staticmethod
+    def layout(*widths):
+        """Return a layout with the given explicit widths in points"""
+        return tuple((width, 1) for width in widths)
+
+    def test_fits_fills_page(self):
+        """Columns that fit keep their widths and the last one takes
+        up the slack"""
+        widths = self.table._fitwidths(self.layout(None, None, None), [30, 40, 50])
+        self.assertEqual(widths[:2], [30, 40])
+        self.assertAlmostEqual(sum(widths), self.available)
+
+    def test_overflow_keeps_narrow_columns(self):
+        """When the columns don't fit, the narrow ones keep their
+        desired widths and the wide ones share what's left"""
+        desired = [30, self.available, 40, self.available]
+        widths = self.table._fitwidths(self.layout(None, None, None, None), desired)
+        self.assertEqual(widths[0], 30)
+        self.assertEqual(widths[2], 40)
+        self.assertAlmostEqual(widths[1], (self.available - 70) / 2)
+        self.assertAlmostEqual(widths[3], widths[1])
+        self.assertAlmostEqual(sum(widths), self.available)
+
+    def test_explicit_widths_preserved(self):
+        """Columns with explicit widths keep them whether or not the
+        others fit"""
+        layout = self.layout(inch, None, 2 * inch, None)
+        for desired in ([0, 30, 0, 40], [0, self.available, 0, self.available]):
+            widths = self.table._fitwidths(layout, desired)
+            self.assertEqual(widths[0], inch)
+            self.assertEqual(widths[2], 2 * inch)
+            self.assertAlmostEqual(sum(widths), self.available)
+
+    def test_minautowidth(self):
+        """Columns never shrink below minautowidth, even when the
+        explicit widths leave no room"""
+        layout = self.layout(self.available, None)
+        widths = self.table._fitwidths(layout, [0, 100])
+        self.assertEqual(widths, [self.available, self.table.minautowidth])
+
+
+class PDFSamplingTests(unittest.TestCase):
+    """Tests for sampling the cells that autowidth measures"""
+
+    def test_sample_is_bounded(self):
+        """Only the head, tail, and reservoir rows are measured"""
+        measured = []
+
+        class RecordingTable(PDFTable):
+            autowidthsample = 2
+
+            def _textwidth(self, text, style, bold=False):
+                measured.append(text)
+                return PDFTable._textwidth(self, text, style, bold)
+
+        rowspec = RowSpec(ColumnSpec('value'))
+        rowsets = [[rowspec({'value': 'row%d' % index})] for index in range(1000)]
+        RecordingTable(autowidth=True)._autowidths(rowsets)
+
+        self.assertTrue(len(measured) <= 6)
+        for text in ('row0', 'row1', 'row998', 'row999'):
+            self.assertTrue(text in measured)
+        self.assertTrue(len(set(measured)) > 4)
+
+    def test_tail_widens_column(self):
+        """A wide value at the end of a long table is still seen"""
+        rowspec = RowSpec(ColumnSpec('value'), ColumnSpec('other'))
+        rows = [rowspec({'value': 'x', 'other': 'x'}) for index in range(1000)]
+        rows.append(rowspec({'value': 'x' * 40, 'other': 'x'}))
+        table = PDFTable(autowidth=True)
+        table.autowidthsample = 2
+        widths = table._autowidths([[row] for row in rows])[table._layout(rowspec)]
+        self.assertTrue(widths[0] >= table._textwidth('x' * 40, table.contentcellstyle))
+
+
+class HTMLTableTests(unittest.TestCase):
+    """Tests for HTMLTable"""
+
+    expected = """\
+<h2>Invoices</h2>
+<p>Explanation</p>
+<table summary="Invoices" class="reporttable">
+  <thead>
+    <tr>
+      <th>Name</th>
+      <th>Amount</th>
+      <th colspan="2">Note</th>
+    </tr>
+    <tr>
+      <th colspan="4">Detail</th>
+    </tr>
+  </thead>
+  <tbody>
+    <tr class="odd">
+      <td class="cell_bold">Smith &amp; Co</td>
+      <td class="cell_money">12.50</td>
+      <td colspan="2">first<br />second</td>
+    </tr>
+    <tr class="odd expand-child">
+      <td colspan="4"></td>
+    </tr>
+    <tr class="even">
+      <td class="cell_bold">Jones</td>
+      <td class="cell_money"></td>
+      <td colspan="2">&lt;b&gt;</td>
+    </tr>
+    <tr class="odd">
+      <td><i>raw</i></td>
+      <td>plain</td>
+      <td class="cell_bold cell_money" colspan="2">wide</td>
+    </tr>
+    <tr class="odd expand-child">
+    </tr>
+  </tbody>
+</table>"""
+
+    def test_render(self):
+        """Rows built by RowSpecs and by hand render as expected"""
+        main = RowSpec(ColumnSpec('name', 'Name', bold=True),
+                       ColumnSpec('amount', 'Amount', money=True),
+                       ColumnSpec('note', 'Note', span=2))
+        child = RowSpec(ColumnSpec('detail', 'Detail', span=4))
+        rowsets = [
+            [main({'name': 'Smith & Co', 'amount': '12.50', 'note': 'first\rsecond'}),
+             child({'detail': None})],
+            main({'name': 'Jones', 'amount': None, 'note': '<b>'}),
+            [TableRow(Cell('<i>raw</i>', StyleAttributes(raw=True)),
+                      Cell('plain'),
+                      Cell('wide', StyleAttributes(bold=True, money=True, span=2))),
+             TableRow()],
+            ]
+        table = HTMLTable('Invoices', 'Explanation', headers=[main, child])
+        self.assertEqual(table.render(rowsets), self.expected)
+
+
+class RecordingSpreadsheetTable(SpreadsheetTable):
+    """SpreadsheetTable that records the names of the worksheets it
+    writes"""
+
+    sheetnames = []
+
+    def _writesheet(self, book, rowsets, sheetname):
+        self.sheetnames.append(sheetname)
+        return SpreadsheetTable._writesheet(self, book, rowsets, sheetname)
+
+
+class SpreadsheetCombinedTests(unittest.TestCase):
+    """Tests for SpreadsheetTable.rendercombined"""
+
+    def setUp(self):
+        RecordingSpreadsheetTable.sheetnames = []
+        self.rowspec = RowSpec(ColumnSpec('value', 'Value'))
+
+    def render(self, titles):
+        """Render one table per title into a single spreadsheet and
+        return the worksheet names"""
+        RecordingSpreadsheetTable.rendercombined(
+            (RecordingSpreadsheetTable(title, headers=self.rowspec),
+             [self.rowspec({'value': index})])
+            for index, title in enumerate(titles))
+        return RecordingSpreadsheetTable.sheetnames
+
+    def test_one_sheet_per_table(self):
+        """Each table gets its own uniquely named worksheet"""
+        sheetnames = self.render(['Smith', 'Jones', 'Smith', None])
+        self.assertEqual(sheetnames, ['Smith', 'Jones', 'Smith (2)', 'Sheet 4'])
+
+    def test_long_repeated_titles(self):
+        """Repeated titles stay unique and within Excel's limit"""
+        sheetnames = self.render(['x' * 31, 'x' * 31, 'y' * 40])
+        self.assertEqual(sheetnames, ['x' * 31, 'x' * 27 + ' (2)', 'y' * 31])
+
+
+class RecordingPDFTable(PDFTable):
+    """PDFTable that records the flowables it would build instead of
+    building them"""
+
+    components = []
+
+    @classmethod
+    def _build(cls, components):
+        cls.components = components
+        return ''
+
+
+class TableBatchTests(unittest.TestCase):
+    """Tests for TableBatch"""
+
+    def setUp(self):
+        RecordingSpreadsheetTable.sheetnames = []
+        self.rowspec = RowSpec(ColumnSpec('value', 'Value'))
+        self.jobs = [('Table %d' % index, self.rowspec,
+                      [self.rowspec({'value': 'value %d' % index})],
+                      {'explanation': 'Explanation %d' % index})
+                     for index in range(5)]
+
+    def test_render_order_and_options(self):
+        """Outputs come back in job order and per-job options reach
+        the tables"""
+        for processes in (1, 2):
+            outputs = TableBatch(HTMLTable, processes=processes).render(self.jobs)
+            self.assertEqual(len(outputs), len(self.jobs))
+            for index, output in enumerate(outputs):
+                self.assertTrue('<h2>Table %d</h2>' % index in output)
+                self.assertTrue('<p>Explanation %d</p>' % index in output)
+                self.assertTrue('<td>value %d</td>' % index in output)
+
+    def test_render_generator_rowsets(self):
+        """Generator rowsets can be sent to worker processes"""
+        jobs = [('Table %d' % index, self.rowspec,
+                 (self.rowspec({'value': value}) for value in range(3)))
+                for index in range(4)]
+        outputs = TableBatch(HTMLTable, processes=2).render(jobs)
+        for output in outputs:
+            for value in range(3):
+                self.assertTrue('<td>%d</td>' % value in output)
+
+    def test_rendercombined_spreadsheet(self):
+        """A combined spreadsheet has one uniquely named worksheet per
+        job"""
+        jobs = self.jobs + [('Table 0', self.rowspec, [])]
+        TableBatch(RecordingSpreadsheetTable).rendercombined(jobs)
+        self.assertEqual(RecordingSpreadsheetTable.sheetnames,
+                         ['Table %d' % index for index in range(5)] + ['Table 0 (2)'])
+
+    def test_rendercombined_pdf(self):
+        """A combined PDF has a page break between each table"""
+        TableBatch(RecordingPDFTable).rendercombined(self.jobs)
+        pagebreaks = [index for index, component in enumerate(RecordingPDFTable.components)
+                      if isinstance(component, PageBreak)]
+        self.assertEqual(len(pagebreaks), len(self.jobs) - 1)
+        self.assertFalse(0 in pagebreaks)
+        self.assertFalse(len(RecordingPDFTable.components) - 1 in pagebreaks)
+
+
+if __name__ == '__main__':
+    unittest.main()